@@ -11,6 +11,7 @@ from __future__ import division
 from idaapi     import *
 from idautils   import *
 import re
+from heapq import heappush, heappop
 
 
 # Change this higher if you want less names associated with each other.
@@ -18,8 +19,61 @@ import re
 PROBABILITY_CUTTOFF         = 0.50
 STRING_PROBABILITY_CUTTOFF  = 0.10
 
-UNNAMED_REGEX          = re.compile( r"^(sub|loc|flt|off|unk|byte|word|dword)_" )
-AUTONAMED_REGEX        = re.compile( r"^z[cdo]?_" )
+UNNAMED_PREFIXES       = ( "sub_", "loc_", "flt_", "off_", "unk_", "byte_", "word_", "dword_" )
+AUTONAMED_PREFIXES     = ( "z_", "zc_", "zd_", "zo_" )
+RENAMEABLE_FUNCTION_PREFIXES = ( "sub_", ) + AUTONAMED_PREFIXES
+
+SAFENAME_FLAGS         = SN_NOCHECK | SN_AUTO | SN_NOWARN
+
+# Names that don't start with one of these are never demangled, so Demangle()
+# isn't called for them
+MANGLED_PREFIXES       = ( "?", "_Z", "__Z", "@" )
+
+# Used by sanitizeString().  The tables keep [a-zA-Z0-9_] and map every
+# other character to '_'.  Byte strings need a 256 entry str table, text
+# strings need a mapping that also covers code points above 255.
+FORMAT_SPEC_REGEX      = re.compile( r'%[\+ -#0]*[\d\.]*[lhLzjt]{0,2}[diufFeEgGxXoscpaAn]' )
+UNDERSCORES_REGEX      = re.compile( r'_+' )
+IDENTIFIER_CHARS       = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_"
+
+class _SanitizeMap(dict):
+    def __missing__( self, ordinal ):
+        self[ordinal] = u'_'
+        return u'_'
+
+SANITIZE_BYTES_TABLE   = "".join( c if c in IDENTIFIER_CHARS else '_'
+                                  for c in map(chr, range(256)) )
+SANITIZE_TEXT_MAP      = _SanitizeMap( (ord(c), ord(c)) for c in IDENTIFIER_CHARS )
+
+# key : canonical EA (function start or head)
+# value : Thing
+_thingCache = {}
+
+# key : base name passed to safeName()
+# value : next suffix attempt that has not collided yet
+_suffixNext = {}
+
+# key : address renamed by safeName()
+# value : base name it was last renamed to
+_lastNamed = {}
+
+# Filled in on first use by getDataHeads() / getFunctionAddrs().  Renaming
+# never adds or removes heads or functions, so these stay valid for the run.
+# resetCaches() clears them and the caches above at the start of each run.
+_dataHeads      = None
+_functionAddrs  = None
+
+# Xref lists, filled in on first use.  Renaming doesn't change xrefs.
+# key : string EA,  value : [ referencing EA ]
+_xrefsTo        = {}
+# key : Thing address,  value : Thing.getXrefs()
+_thingXrefs     = {}
+
+# key : mangled name,  value : Demangle() result, "" if it can't be demangled
+_demangleCache  = {}
+
+# Number of safeName() calls over the run
+renamesTotal    = 0
 
 
 ##############################################################################
@@ -35,57 +89,57 @@ class MarkovModel:
 
 
     ##############################################################################
-    def addTransition( self, fromStateID, toStateID ):
-        
-        if not fromStateID in self.states:
-            newState = None
+    def getState( self, fromStateID ):
+        state = self.states.get(fromStateID)
+        if state is None:
             if self.forStrings:
-                newState = MarkovStateStrings(fromStateID, self)
+                state = MarkovStateStrings(fromStateID, self)
             else:
-                newState = MarkovStateCalls(fromStateID, self)
-            self.states[fromStateID] = newState
+                state = MarkovStateCalls(fromStateID, self)
+            self.states[fromStateID] = state
+        return state
 
-        if not toStateID in self.xrefs:
-            self.xrefs[toStateID] = 0
+    ##############################################################################
+    def addTransition( self, fromStateID, toStateID ):
+        
+        state = self.getState(fromStateID)
 
-        self.xrefs[toStateID] += 1
+        xrefs = self.xrefs
+        xrefs[toStateID] = xrefs.get(toStateID, 0) + 1
 
-        self.states[fromStateID].addTransition( toStateID )
+        state.addTransition( toStateID )
+
+    ##############################################################################
+    def addTransitions( self, fromStateID, toStateIDs ):
+        if not toStateIDs:
+            return
+
+        state = self.getState(fromStateID)
+
+        xrefs = self.xrefs
+        for toStateID in toStateIDs:
+            xrefs[toStateID] = xrefs.get(toStateID, 0) + 1
+
+        state.addTransitions( toStateIDs )
 
     ##############################################################################
     def cull( self, cutoffWeight ):
-        for sourceID in self.states:
-            source = self.states[sourceID]
-            edges = source.edges
-            cullList = []
-            for destID in edges:
-                if source.probability(destID) < cutoffWeight:
-                    cullList.append(destID)
-            for destID in cullList:
-                del source.edges[destID]
+        for source in self.states.values():
+            source.cull(cutoffWeight)
 
 ##############################################################################
 # MarkovHashable
 ##############################################################################
-class MarkovHashable:
+class MarkovHashable(object):
+    # States are only ever keyed by their integer stateID, never by the
+    # object itself, so no __hash__/__eq__ is needed
+    __slots__ = ( 'stateID', 'model' )
 
     ##############################################################################
     def __init__(self, stateID, model):
         self.stateID    = stateID
         self.model      = model
 
-    ##############################################################################
-    def __hash__( self ):        
-        return self.stateID
-
-    ##############################################################################
-    def __eq__(self, other ):
-        return other.stateID == self.stateID
-
-    ##############################################################################
-    def __cmp__( self, other ):
-        return self.stateID - other.stateID
-
     ##############################################################################
     def __repr__(self):
         return "%x" % self.stateID
@@ -95,22 +149,26 @@ class MarkovHashable:
 # MarkovState
 ##############################################################################
 class MarkovState(MarkovHashable):
+    __slots__ = ( 'transistions_total', 'edges' )
 
     def __init__(self, stateID, model):
         MarkovHashable.__init__(self, stateID, model)        
 
         self.transistions_total     = 0
         self.edges                  = {}
-        self.model                  = model
 
 
     def addTransition( self, toStateID ):
-        if not toStateID in self.edges:
-            self.edges[toStateID] = 0
-
-        self.edges[toStateID]   += 1
+        edges = self.edges
+        edges[toStateID]         = edges.get(toStateID, 0) + 1
         self.transistions_total += 1
 
+    def addTransitions( self, toStateIDs ):
+        edges = self.edges
+        for toStateID in toStateIDs:
+            edges[toStateID] = edges.get(toStateID, 0) + 1
+        self.transistions_total += len(toStateIDs)
+
     def probabilityToString( self, toStateID ):
         return ": prob %0.3f.  %d edges,  %d xrefs, %d transitions" % (
             self.probability(toStateID),
@@ -123,6 +181,7 @@ class MarkovState(MarkovHashable):
 # MarkovStateStrings
 ##############################################################################
 class MarkovStateStrings(MarkovState):
+    __slots__ = ()
 
     def __init__(self, stateID, model):
         MarkovState.__init__(self, stateID, model) 
@@ -130,11 +189,22 @@ class MarkovStateStrings(MarkovState):
     def probability( self, toStateID ):
         return self.edges[toStateID] / self.model.xrefs[toStateID]        
 
+    def cull( self, cutoffWeight ):
+        # Cull in place so the surviving edges keep their order, which breaks
+        # ties when they're sorted by probability
+        xrefs = self.model.xrefs
+        edges = self.edges
+        cullList = [ destID for destID, count in edges.items()
+                     if count < cutoffWeight * xrefs[destID] ]
+        for destID in cullList:
+            del edges[destID]
+
 
 ##############################################################################
 # MarkovStateCalls
 ##############################################################################
 class MarkovStateCalls(MarkovState):
+    __slots__ = ()
 
     def __init__(self, stateID, model):
         MarkovState.__init__(self, stateID, model) 
@@ -142,19 +212,22 @@ class MarkovStateCalls(MarkovState):
     def probability( self, toStateID ):
         return self.edges[toStateID] /   self.transistions_total
 
+    def cull( self, cutoffWeight ):
+        # probability >= cutoff, without a division per edge
+        minCount = cutoffWeight * self.transistions_total
+        edges = self.edges
+        cullList = [ destID for destID, count in edges.items()
+                     if count < minCount ]
+        for destID in cullList:
+            del edges[destID]
 
-##############################################################################
-# Stats
-##############################################################################
-class Stats:
-    renamesTotal        = 0
 
 ##############################################################################
 # stripExistingPrefix()
 ##############################################################################
 def stripExistingPrefix( name ):
-    if AUTONAMED_REGEX.match(name):
-        return AUTONAMED_REGEX.sub( '', name )
+    if name.startswith(AUTONAMED_PREFIXES):
+        return name[name.index('_')+1:]
     else:
         return name
 
@@ -162,23 +235,34 @@ def stripExistingPrefix( name ):
 # safeName()
 ##############################################################################
 def safeName( addr, baseName, msg="" ):
+    global renamesTotal
+
+    # Already renamed to this baseName by an earlier call, so the name it got
+    # then (possibly with a suffix) is still the right one
+    if _lastNamed.get(addr) == baseName:
+        return
 
     oldName = Name(addr)
     if not oldName:
         msg = "!!! Should not rename something that previously had no name: %s -> %s @ %x: %s" % (oldName, baseName, addr, msg)
         print( msg )
         raise( msg )
+    Thing.invalidate(addr)
     # if oldName == baseName  or oldName.startswith(baseName):
     
 
-    newName = baseName
-    Stats.renamesTotal += 1
+    renamesTotal += 1
 
-    sc = MakeNameEx( addr, newName,  SN_NOCHECK | SN_AUTO | SN_NOWARN )
-    i = 0
-    while sc == 0:
-        newName = baseName + str(i)
-        sc = MakeNameEx( addr, newName,  SN_NOCHECK | SN_AUTO | SN_NOWARN )
+    # Attempt 0 is baseName itself, attempt n is baseName + str(n-1).  Start
+    # past the attempts that already collided for this baseName.
+    i = _suffixNext.get(baseName, 0)
+    while True:
+        if i == 0:
+            newName = baseName
+        else:
+            newName = baseName + str(i-1)
+        if MakeNameEx( addr, newName, SAFENAME_FLAGS ):
+            break
         i += 1
         if i > 100000:
             errmsg = "Reached limit of autonaming.  Trying to create name %s which mean it went through %d iterations" % (newName, i)
@@ -186,17 +270,87 @@ def safeName( addr, baseName, msg="" ):
             raise( errmsg )
 
     
+    _suffixNext[baseName] = i + 1
+    _lastNamed[addr] = baseName
+
     print( "%s -> %s%s" % (oldName, newName, msg) )
     
+##############################################################################
+# getDataHeads()
+##############################################################################
+def getDataHeads():
+    global _dataHeads
+    if _dataHeads is None:
+        _dataHeads = []
+        for segment in Segments():
+            # We don't want to include functions since they're handled separately
+            if get_segm_class( getseg(segment) ) == "CODE":
+                continue
+            _dataHeads.extend( Heads( segment, SegEnd(segment) ) )
+    return _dataHeads
+
+##############################################################################
+# getFunctionAddrs()
+##############################################################################
+def getFunctionAddrs():
+    global _functionAddrs
+    if _functionAddrs is None:
+        _functionAddrs = list( Functions() )
+    return _functionAddrs
+
+##############################################################################
+# getXrefsTo()
+##############################################################################
+def getXrefsTo( ea ):
+    frms = _xrefsTo.get(ea)
+    if frms is None:
+        frms = [ xref.frm for xref in XrefsTo(ea, 0) ]
+        _xrefsTo[ea] = frms
+    return frms
+
 ##############################################################################
 # Thing
 ##############################################################################
-class Thing:
+class Thing(object):
+    __slots__ = ( 'addr', 'endEA', 'name', 'isFunction', 'isCode', 'isData',
+                  'xrefs', '_isNamed', '_stripped' )
 
     #########################################################################
     def __init__( self, addr ):
+        self._populate( addr, get_func(addr) )
+
+    #########################################################################
+    @classmethod
+    def get( cls, addr ):
+        # Cache keys are function starts and heads, so a direct hit needs no
+        # get_func() round trip
+        thing = _thingCache.get(addr)
+        if thing is not None:
+            return thing
+
+        func = get_func(addr)
+        if func:
+            key = func.startEA
+        else:
+            key = addr
+        thing = _thingCache.get(key)
+        if thing is None:
+            thing = cls.__new__(cls)
+            thing._populate( key, func )
+            _thingCache[key] = thing
+        return thing
+
+    #########################################################################
+    @staticmethod
+    def invalidate( addr ):
+        _thingCache.pop(addr, None)
+
+    #########################################################################
+    def _populate( self, addr, funcAddr ):
         self.isFunction         = False
         self.xrefs              = None
+        self._isNamed           = None
+        self._stripped          = None
         self.endEA              = None
         self.isCode             = False
         self.isData             = False
@@ -207,7 +361,6 @@ class Thing:
         if      "DATA" == segmentClazz:
             self.isData = True
 
-        funcAddr = get_func(addr)
         if funcAddr:
             self.addr       = funcAddr.startEA
             self.endEA      = funcAddr.endEA
@@ -218,9 +371,13 @@ class Thing:
             self.isFunction = False        
 
         self.name = Name(self.addr)
-        testName = Demangle( self.name, INF_LONG_DN)
-        if testName:
-            self.name = testName
+        if self.name and self.name.startswith(MANGLED_PREFIXES):
+            testName = _demangleCache.get(self.name)
+            if testName is None:
+                testName = Demangle( self.name, INF_LONG_DN) or ""
+                _demangleCache[self.name] = testName
+            if testName:
+                self.name = testName
 
     #########################################################################
     # def xrefsFrom(self):
@@ -230,25 +387,38 @@ class Thing:
 
     #########################################################################
     def getXrefs(self):
-        if self.xrefs:
+        if self.xrefs is not None:
+            return self.xrefs
+
+        # Renaming drops the Thing from the cache but not its xrefs
+        xrefs = _thingXrefs.get(self.addr)
+        if xrefs is not None:
+            self.xrefs = xrefs
             return self.xrefs
         
-        self.xrefs = []
+        xrefs = []
         if self.isFunction:
             fromAddrs = FuncItems( self.addr )
         else:
             fromAddrs = [self.addr]
 
+        lo, hi = self.addr, self.endEA
+        append = xrefs.append
+        xrefsFrom = XrefsFrom
         for fromAddr in fromAddrs:
-            for xrefFrom in XrefsFrom( fromAddr, 0 ):
+            for xrefFrom in xrefsFrom( fromAddr, 0 ):
                 # Make sure it's not self referential
                 # this does sometimes result in false positives because of the end
                 # condition, but you can see why that might be beneficial most of the
                 # time
-                if xrefFrom.to < self.addr or xrefFrom.to > self.endEA: 
-                    #self.xrefs.add(xrefFrom.to)
-                    self.xrefs.append(xrefFrom.to)
-
+                to = xrefFrom.to
+                if to < lo or to > hi: 
+                    append(to)
+
+        # Duplicates are kept on purpose, they're the transition counts for
+        # the Markov model
+        _thingXrefs[self.addr] = xrefs
+        self.xrefs = xrefs
         return self.xrefs
 
     #########################################################################    
@@ -265,7 +435,15 @@ class Thing:
 
     #########################################################################
     def isNamed(self):
-        return self.name and not UNNAMED_REGEX.match(self.name)
+        if self._isNamed is None:
+            self._isNamed = bool(self.name) and not self.name.startswith(UNNAMED_PREFIXES)
+        return self._isNamed
+
+    #########################################################################
+    def strippedName(self):
+        if self._stripped is None:
+            self._stripped = stripExistingPrefix(self.name)
+        return self._stripped
 
     #########################################################################
     def suffix(self):
@@ -297,34 +475,47 @@ def resetExistingNames():
         # We don't want to include functions since we'll do that in the next block
         for head in Heads( segment, SegEnd(segment) ):
             name = Name(head)
-            if name and AUTONAMED_REGEX.match(name):
+            if name and name.startswith(AUTONAMED_PREFIXES):
                 print(name)
                 MakeName( head, "" )
+                Thing.invalidate(head)
+                _lastNamed.pop(head, None)
     print("Done resetting names...")
 
 
+##############################################################################
+# resetCaches()
+##############################################################################
+def resetCaches():
+    # The caches are only valid for one run, the IDB can change in between
+    global _dataHeads, _functionAddrs
+    _thingCache.clear()
+    _suffixNext.clear()
+    _lastNamed.clear()
+    _xrefsTo.clear()
+    _thingXrefs.clear()
+    _demangleCache.clear()
+    _dataHeads      = None
+    _functionAddrs  = None
+
+
 ##############################################################################
 # renameData()
 ##############################################################################
 def renameData():
     print("Renaming Data...")
     changes = 0
-    for segment in Segments():
-        seg = getseg(segment)
-        clazz = get_segm_class(seg)
-        if clazz == "CODE":
-            continue
-        for head in Heads( segment, SegEnd(segment) ):
-            thing = Thing(head)
-            if not thing.isFunction and thing.name and not thing.isNamed():
-                xrefs_from = thing.xrefsFrom()
-                if len(xrefs_from) == 1:
-                    reffedThing = xrefs_from.pop()
-                    if( reffedThing.isNamed() ):
-                        newName = thing.getPrefix() + stripExistingPrefix(reffedThing.name)
-                        #print( "%s -> %s" % ( thing, newName) )                        
-                        safeName( thing.addr, newName  )
-                        changes += 1
+    for head in getDataHeads():
+        thing = Thing.get(head)
+        if not thing.isFunction and thing.name and not thing.isNamed():
+            xrefs_from = thing.xrefsFrom()
+            if len(xrefs_from) == 1:
+                reffedThing = xrefs_from.pop()
+                if( reffedThing.isNamed() ):
+                    newName = thing.getPrefix() + reffedThing.strippedName()
+                    #print( "%s -> %s" % ( thing, newName) )                        
+                    safeName( thing.addr, newName  )
+                    changes += 1
     return changes
 
 ##############################################################################
@@ -333,16 +524,15 @@ def renameData():
 def renameFunctions():
     print("Renaming Functions...")
     changes = 0
-    allFunctionAddrs = Functions()
-    for funcAddr in allFunctionAddrs:
-        func = Thing(funcAddr)
+    for funcAddr in getFunctionAddrs():
+        func = Thing.get(funcAddr)
         if not func.isNamed():
             #xrefs_to = func.xrefsTo()
             xrefs_from = func.xrefsFrom()
             if len(xrefs_from) == 1:
                 calledThing = xrefs_from.pop()
                 if( calledThing.isNamed() ):
-                    newName = func.getPrefix() + stripExistingPrefix(calledThing.name)
+                    newName = func.getPrefix() + calledThing.strippedName()
                     #print( "%s -> %s" % ( func, newName) )
                     changes += 1
                     safeName(func.addr, newName )
@@ -361,43 +551,45 @@ def sanitizeString(s):
     if not s:
         return s
     ret = s
-    ret =  re.sub( r'\0+', '', ret )
-    ret =  re.sub( r'%[\+ -#0]*[\d\.]*[lhLzjt]{0,2}[diufFeEgGxXoscpaAn]', '_', ret  )
-    ret =  re.sub( r'[^a-zA-Z0-9_]+', '_', ret )
-    ret =  re.sub( r'_+', '_', ret )
+    ret =  ret.replace( '\0', '' )
+    # Most strings have no format specifiers or runs of '_', so skip the
+    # regex passes unless they can match
+    if '%' in ret:
+        ret =  FORMAT_SPEC_REGEX.sub( '_', ret )
+    if isinstance(ret, bytes):
+        ret =  ret.translate( SANITIZE_BYTES_TABLE )
+    else:
+        ret =  ret.translate( SANITIZE_TEXT_MAP )
+    if '__' in ret:
+        ret =  UNDERSCORES_REGEX.sub( '_', ret )
     return ret.strip('_')
 
 ##############################################################################
 # processStringXrefs()
 ##############################################################################
-def processStringXrefs(item, functionsHash):
+def processStringXrefs(item, functionNames):
+    # Read-only: returns the (funcAddr, refAddr) link for the string, or None
+    # if it isn't referenced by exactly one renameable function
     links = [] 
-    string = str(item)
-    string = string.strip()
 
-    for xref in XrefsTo(item.ea, 0):
-        refAddr = xref.frm
+    for refAddr in getXrefsTo(item.ea):
         func = get_func(refAddr)
         if func:
             funcAddr = func.startEA
-            functionName = Name(funcAddr)
+            functionName = functionNames.get(funcAddr)
+            if functionName is None:
+                functionName = Name(funcAddr)
+                functionNames[funcAddr] = functionName
 
-            if( functionName.startswith( 'sub_' ) or AUTONAMED_REGEX.match(functionName) ):
-                link = (funcAddr, refAddr, string )
+            if( functionName.startswith( RENAMEABLE_FUNCTION_PREFIXES ) ):
+                link = (funcAddr, refAddr)
                 links.append(link)
-
+                if( len(links) > 1 ):
+                    return None
 
     if( len(links) == 1 ):
-        link        = links[0]
-        funcAddr    = link[0]
-        lastLink    = link
-        try:
-            lastLink = functionsHash[funcAddr]
-        except:
-            functionsHash[funcAddr] = link
-
-        if( link[1] < lastLink[1] ):
-            functionsHash[funcAddr] = link
+        return links[0]
+    return None
 
  
 ##############################################################################
@@ -408,25 +600,48 @@ def renameFunctionsBasedOnStrings():
     allStrings = Strings(False)
     allStrings.setup( strtypes = Strings.STR_C |Strings.STR_UNICODE )
     # key : function EA
-    # value : ( Xref, string )
-
-
+    # value : ( Xref, index into stringTable )
     functionsHash = {}
+    # Deduplicated strings referenced from functionsHash
+    stringTable = []
+    stringIndex = {}
+    # Nothing is renamed until every string is processed, so function names
+    # can be looked up once and shared between strings
+    functionNames = {}
 
     for index, stringItem in enumerate(allStrings) :
         if stringItem is None :
             print("Nothing for string #%d" % index )
-        else:
-            processStringXrefs( stringItem, functionsHash )
+            continue
+        link = processStringXrefs( stringItem, functionNames )
+        if link is None:
+            continue
 
+        # Each function keeps the string with the lowest referencing address
+        funcAddr, refAddr = link
+        lastLink = functionsHash.get(funcAddr)
+        if( lastLink is None or refAddr < lastLink[0] ):
+            # Only strings that end up linked to a function are read and kept
+            string = str(stringItem)
+            string = string.strip()
+            stringID = stringIndex.get(string)
+            if stringID is None:
+                stringID = len(stringTable)
+                stringTable.append(string)
+                stringIndex[string] = stringID
+            functionsHash[funcAddr] = (refAddr, stringID)
+
+    renamed = []
     for funcAddr in functionsHash.keys() :
         link    = functionsHash[funcAddr]
-        refAddr = link[1]
-        string  = link[2]
-        oldThing = Thing(funcAddr)
+        refAddr = link[0]
+        string  = stringTable[link[1]]
+        oldThing = Thing.get(funcAddr)
         if( not oldThing.isNamed() ):
             newName = oldThing.getPrefix() +  sanitizeString(string)
             safeName( funcAddr , newName ) 
+            renamed.append(funcAddr)
+    return renamed
 
 
 ##############################################################################
@@ -450,61 +665,94 @@ def runCallsModel():
     markovModel = MarkovModel(False)
 
     print("Building markov model for data...")
-    for segment in Segments():
-        seg = getseg(segment)
-        clazz = get_segm_class(seg)
-        # We don't want to include functions since we'll do that in the next block
-        if clazz == "CODE":
-            continue
-        for head in Heads( segment, SegEnd(segment) ):
-            thing = Thing(head)
-            if thing.name:
-                for xref in thing.getXrefs():
-                    markovModel.addTransition( thing.addr, xref )
+    for head in getDataHeads():
+        thing = Thing.get(head)
+        if thing.name:
+            markovModel.addTransitions( thing.addr, thing.getXrefs() )
 
 
     print("Building markov model for functions...")
     print("... chill mon.. this may take a while...")
     changes = 0
-    allFunctionAddrs = Functions()
-    for funcAddr in allFunctionAddrs:
-        func = Thing(funcAddr)
+    for funcAddr in getFunctionAddrs():
+        func = Thing.get(funcAddr)
         if not func.isNamed():
-            for xref in func.getXrefs():
-                markovModel.addTransition( func.addr, xref )
+            markovModel.addTransitions( func.addr, func.getXrefs() )
 
 
     print("Culling at %d %%" % (PROBABILITY_CUTTOFF*100) )
     markovModel.cull(PROBABILITY_CUTTOFF)
 
-    changes = 1
-    iteration = 0
-    while changes > 0:
-        print(" Pass %d" % iteration )
-        changes = 0
-        for sourceID in markovModel.states:
-            sourceThing = Thing(sourceID)
-            if sourceThing.isNamed():
-                continue
-            source = markovModel.states[sourceID]
-            edges = sorted( source.edges, key=source.probability )
-            for destID in edges:
-                destThing = Thing(destID)
-                if destThing.isNamed():
-                    newName = sourceThing.getPrefix() +  stripExistingPrefix( destThing.name )
-                    msg = ": " + source.probabilityToString(destID)
-                    safeName( sourceThing.addr, newName, msg )
-                    edge = source.edges[destID]
-                    changes += 1
-                    break
-        if iteration==0:
-            renameFunctionsBasedOnStrings()
+    # Edge counts don't change after culling, so each state's edges are sorted
+    # once here
+    pending = [ (source, sorted( source.edges, key=source.probability ))
+                for source in markovModel.states.values() if source.edges ]
+
+    # key : address of a dest Thing
+    # value : [ index into pending ] for every source with an edge to it
+    referrers = {}
+    for index, entry in enumerate(pending):
+        for destID in entry[1]:
+            referrers.setdefault( Thing.get(destID).addr, [] ).append(index)
+
+    # Replays the old "rescan everything until no changes" passes, but only
+    # visits sources that one of their dests got renamed since their last
+    # visit.  The heap is ordered by (pass, index into pending) so sources are
+    # still visited in the same order and pick the same names as before.
+    # Pass 0 visits everything; the string based renames happen between pass 0
+    # and pass 1.
+    changes = 0
+    heap = [ (0, index) for index in range(len(pending)) ]
+    queued = set(heap)
+    stringsDone = False
+    while heap or not stringsDone:
+        if not stringsDone and ( not heap or heap[0][0] > 0 ):
+            stringsDone = True
+            for funcAddr in renameFunctionsBasedOnStrings():
+                queueReferrers( heap, queued, referrers.get(funcAddr, ()), 0, len(pending) )
+            continue
+
+        passIndex, index = heappop(heap)
+        queued.discard( (passIndex, index) )
+        source, edges = pending[index]
+        if renameFromEdges( source, edges ):
             changes += 1
-        iteration += 1
+            queueReferrers( heap, queued, referrers.get(source.stateID, ()), passIndex, index )
 
-        print("Pass %d, %d changes" % (iteration, changes) )
+    print("Calls model made %d changes" % changes )
     return changes
 
+##############################################################################
+# queueReferrers()
+##############################################################################
+def queueReferrers( heap, queued, referrerIndexes, passIndex, index ):
+    # Sources after the current one still get visited in this pass, the rest
+    # wait for the next one
+    for refIndex in referrerIndexes:
+        if refIndex > index:
+            item = (passIndex, refIndex)
+        else:
+            item = (passIndex + 1, refIndex)
+        if item not in queued:
+            queued.add(item)
+            heappush( heap, item )
+
+##############################################################################
+# renameFromEdges()
+##############################################################################
+def renameFromEdges( source, edges ):
+    sourceThing = Thing.get(source.stateID)
+    if sourceThing.isNamed():
+        return False
+    for destID in edges:
+        destThing = Thing.get(destID)
+        if destThing.isNamed():
+            newName = sourceThing.getPrefix() +  destThing.strippedName()
+            msg = ": " + source.probabilityToString(destID)
+            safeName( sourceThing.addr, newName, msg )
+            return True
+    return False
+
 ##############################################################################
 #
 ##############################################################################
@@ -527,8 +775,8 @@ def runStringsModel( filterEnabled ):
         stringAddr = stringItem.ea
         string = str(stringItem)
         if not filterEnabled or validIdentifierRegex.match(string):
-            for xref in XrefsTo(stringAddr, 0):
-                thing = Thing(xref.frm)
+            for refAddr in getXrefsTo(stringAddr):
+                thing = Thing.get(refAddr)
                 if thing.name:
                     stringModel.addTransition( thing.addr, stringAddr )
 
@@ -537,7 +785,7 @@ def runStringsModel( filterEnabled ):
     stringModel.cull(STRING_PROBABILITY_CUTTOFF)
     
     for sourceID in stringModel.states:
-        sourceThing = Thing(sourceID)
+        sourceThing = Thing.get(sourceID)
         if sourceThing.isNamed():
             continue
         source = stringModel.states[sourceID]
@@ -561,6 +809,7 @@ def runStringsModel( filterEnabled ):
 # main()
 ##############################################################################
 def main():
+    resetCaches()
     resetOld = AskYN( 0, "Reset any existing names generated from previous runs of this script?")
     if resetOld == -1:
         return
@@ -572,7 +821,7 @@ def main():
 
     runCallsModel()
 
-    print("DONE! %d changes total." % Stats.renamesTotal )
+    print("DONE! %d changes total." % renamesTotal )
 
 
 ##############################################################################
@@ -580,6 +829,7 @@ def main():
 ##############################################################################
 def main_old():
 
+    resetCaches()
     fixupIdaStringNames()
     renameFunctionsBasedOnStrings()
     changes = 1
@@ -594,7 +844,7 @@ def main_old():
         print( "Pass %d had %d changes" % (iteration, changes ) )
     
 
-    print("Done with a total of %d changes" % Stats.renamesTotal )
+    print("Done with a total of %d changes" % renamesTotal )
 
 if __name__ == '__main__':
     main()